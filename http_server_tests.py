@@ -1,86 +1,199 @@
 import pytest
+import select
 import socket
 import threading
 import time
 from urllib.parse import urlparse
 import re
 
+from main import SimpleHTTPServer
+
+_CONTENT_LENGTH_RE = re.compile(rb"Content-Length:\s*(\d+)", re.IGNORECASE)
+_CONNECTION_RE = re.compile(rb"^Connection:\s*(\S+)", re.IGNORECASE | re.MULTILINE)
+
 
 class HTTPClient:
-    """Simple HTTP client for testing that sends raw HTTP requests"""
+    """Simple HTTP client for testing that sends raw HTTP requests
+
+    The connection is kept open between requests (HTTP/1.1 keep-alive) and
+    only re-established when the server closes it.
+    """
 
     def __init__(self, host="localhost", port=8080):
         self.host = host
         self.port = port
+        self._sock = None
+
+    def close(self):
+        """Close the persistent connection, if any"""
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(5.0)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            sock.connect((self.host, self.port))
+        except OSError:
+            sock.close()
+            raise
+        self._sock = sock
+
+    def _connection_dropped(self):
+        # An idle keep-alive connection should have nothing to read; if it is
+        # readable the server either closed it or sent something unexpected.
+        readable, _, _ = select.select([self._sock], [], [], 0)
+        return bool(readable)
 
     def send_request(self, method, path, headers=None, body=None, http_version="1.1"):
         """Send a raw HTTP request and return response"""
         if headers is None:
             headers = {}
 
-        # Build request
-        request_line = f"{method} {path} HTTP/{http_version}\r\n"
+        # Build request as a list of encoded pieces
+        parts = [f"{method} {path} HTTP/{http_version}\r\n".encode("utf-8")]
 
         # Add Host header (required for HTTP/1.1)
         if "Host" not in headers:
             headers["Host"] = f"{self.host}:{self.port}"
 
         # Add Content-Length if body is provided
-        if body and "Content-Length" not in headers:
-            headers["Content-Length"] = str(len(body.encode("utf-8")))
+        body_bytes = body.encode("utf-8") if body else b""
+        if body_bytes and "Content-Length" not in headers:
+            headers["Content-Length"] = str(len(body_bytes))
 
-        # Build headers
-        header_lines = []
+        # Add headers
         for key, value in headers.items():
-            header_lines.append(f"{key}: {value}\r\n")
+            parts.append(f"{key}: {value}\r\n".encode("utf-8"))
 
         # Complete request
-        request = request_line + "".join(header_lines) + "\r\n"
-        if body:
-            request += body
+        parts.append(b"\r\n")
+        if body_bytes:
+            parts.append(body_bytes)
 
-        # Send request
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(5.0)
-        try:
-            sock.connect((self.host, self.port))
-            sock.send(request.encode("utf-8"))
+        # Reuse the open connection unless the server has dropped it
+        if self._sock is not None and self._connection_dropped():
+            self.close()
+        reused = self._sock is not None
+        if not reused:
+            self._connect()
 
-            # Read response
-            response = b""
-            while True:
-                chunk = sock.recv(4096)
-                if not chunk:
-                    break
-                response += chunk
-
-                # Check if we have a complete response
-                if b"\r\n\r\n" in response:
-                    headers_end = response.find(b"\r\n\r\n") + 4
-                    headers_part = response[:headers_end].decode("utf-8")
-                    body_part = response[headers_end:]
-
-                    # Check Content-Length to see if we have full body
-                    content_length_match = re.search(
-                        r"Content-Length:\s*(\d+)", headers_part, re.IGNORECASE
-                    )
-                    if content_length_match:
-                        expected_length = int(content_length_match.group(1))
-                        if len(body_part) >= expected_length:
-                            break
-                    else:
-                        # No Content-Length, assume response is complete
-                        break
-
-            return response.decode("utf-8", errors="ignore")
-        finally:
-            sock.close()
+        try:
+            try:
+                response, framed = self._exchange(parts, method)
+            except ConnectionError:
+                if not reused:
+                    raise
+                response = b""
+            if not response and reused:
+                # The server closed the idle connection under us; retry once
+                # on a fresh one.
+                self.close()
+                self._connect()
+                response, framed = self._exchange(parts, method)
+        except Exception:
+            self.close()
+            raise
+
+        headers_end = response.find(b"\r\n\r\n")
+        connection_match = _CONNECTION_RE.search(response, 0, headers_end)
+        connection = connection_match.group(1).lower() if connection_match else b""
+        if (
+            not framed
+            or connection == b"close"
+            or headers.get("Connection", "").lower() == "close"
+            or (http_version == "1.0" and connection != b"keep-alive")
+        ):
+            self.close()
+
+        return response.decode("utf-8", errors="ignore")
+
+    def _send(self, parts):
+        """Send the request pieces in one gathered write where possible"""
+        sock = self._sock
+        if not hasattr(sock, "sendmsg"):
+            sock.sendall(b"".join(parts))
+            return
+        sent = sock.sendmsg(parts)
+        if sent < sum(map(len, parts)):
+            sock.sendall(b"".join(parts)[sent:])
+
+    def _exchange(self, parts, method):
+        """Send one request on the open connection and read its response
+
+        Returns the raw response and whether its end was known from the
+        framing (as opposed to guessed or read until the server closed).
+        """
+        self._send(parts)
+        sock = self._sock
+
+        # Read response
+        response = bytearray()
+        scan_from = 0
+        expected_end = None
+        while True:
+            chunk = sock.recv(4096)
+            if not chunk:
+                return response, False
+            response.extend(chunk)
+
+            if expected_end is None:
+                # Only scan the new data, backing up 3 bytes in case the
+                # separator straddles two recvs
+                headers_end = response.find(b"\r\n\r\n", scan_from)
+                if headers_end < 0:
+                    scan_from = max(0, len(response) - 3)
+                    continue
+                headers_end += 4
+
+                # Responses to HEAD, 204 and 304 never carry a body
+                if method == "HEAD" or response[9:12] in (b"204", b"304"):
+                    return response, True
+
+                # Content-Length tells us where the body ends
+                content_length_match = _CONTENT_LENGTH_RE.search(
+                    response, 0, headers_end
+                )
+                if not content_length_match:
+                    # No Content-Length, assume response is complete
+                    return response, False
+                expected_end = headers_end + int(content_length_match.group(1))
+
+            # Check if we have the full body
+            if len(response) >= expected_end:
+                return response, True
 
 
 @pytest.fixture
 def http_client():
     """Fixture providing HTTP client"""
-    return HTTPClient()
+    client = HTTPClient()
+    yield client
+    client.close()
+
+
+class ShortTimeoutServer(SimpleHTTPServer):
+    KEEPALIVE_TIMEOUT = 0.5
+    REQUEST_TIMEOUT = 0.5
+    LINGER_TIMEOUT = 0.2
+
+
+@pytest.fixture
+def short_timeout_server():
+    """Fixture running a server with short timeouts; yields (host, port)"""
+    server = ShortTimeoutServer("127.0.0.1", 0)
+    host, port = server._socket.getsockname()
+    threading.Thread(target=server.serve, daemon=True).start()
+    # serve() starts listening in the thread, so wait until it accepts
+    for _ in range(50):
+        try:
+            socket.create_connection((host, port), timeout=1.0).close()
+            break
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+    yield host, port
 
 
 def verify_response_status_line(
@@ -96,7 +209,9 @@ def verify_response_status_line(
     Returns:
         list: Components of status line [protocol, status_code, status_message]
     """
-    status_parts = response.split("\r\n\r\n")[0].split(" ")
+    status_end = response.find("\r\n")
+    status_line = response[:status_end] if status_end >= 0 else response
+    status_parts = status_line.split(" ", 2)
     assert (
         status_parts[0] == expected_protocol
     ), f"Expected {expected_protocol}, got {status_parts[0]}"
@@ -199,6 +314,27 @@ class TestHTTPVersions:
         response = http_client.send_request("GET", "/", http_version="1.0")
         verify_response_status_line(response)
 
+    def test_http_1_0_keep_alive(self, http_client):
+        """Test HTTP/1.0 keep-alive is confirmed and the connection reused"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(5.0)
+        try:
+            sock.connect((http_client.host, http_client.port))
+            sock.sendall(b"GET / HTTP/1.0\r\nConnection: keep-alive\r\n\r\n")
+            response = sock.recv(4096).decode("utf-8")
+            verify_response_status_line(response)
+            assert "Connection: keep-alive" in response
+
+            # Without keep-alive the server answers and closes
+            sock.sendall(b"GET / HTTP/1.0\r\n\r\n")
+            response = b""
+            while chunk := sock.recv(4096):
+                response += chunk
+            verify_response_status_line(response.decode("utf-8"))
+            assert b"Connection: keep-alive" not in response
+        finally:
+            sock.close()
+
     def test_http_1_1_request(self, http_client):
         """Test HTTP/1.1 request (default)"""
         response = http_client.send_request("GET", "/")
@@ -250,15 +386,22 @@ class TestHTTPResponseValidation:
         """Test response headers are properly formatted"""
         response = http_client.send_request("GET", "/")
 
-        # Split headers and body
-        parts = response.split("\r\n\r\n", 1)
-        header_section = parts[0]
-
-        # Check each header line (skip status line)
-        header_lines = header_section.split("\r\n")[1:]
-        for line in header_lines:
+        # Find the end of the header block
+        headers_end = response.find("\r\n\r\n")
+        if headers_end < 0:
+            headers_end = len(response)
+
+        # Check each header line in place (skip status line)
+        status_end = response.find("\r\n", 0, headers_end)
+        line_start = status_end + 2 if status_end >= 0 else headers_end
+        while line_start < headers_end:
+            line_end = response.find("\r\n", line_start, headers_end)
+            if line_end < 0:
+                line_end = headers_end
+            line = response[line_start:line_end]
             if line.strip():  # Skip empty lines
                 assert ":" in line, f"Invalid header format: {line}"
+            line_start = line_end + 2
 
     def test_response_has_required_headers(self, http_client):
         """Test response includes required headers"""
@@ -306,6 +449,64 @@ class TestErrorHandling:
         finally:
             sock.close()
 
+    def test_bare_lf_request_line(self, http_client):
+        """Test request line ending in LF instead of CRLF is rejected"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(5.0)
+        try:
+            sock.connect((http_client.host, http_client.port))
+            sock.send(b"GET / HTTP/1.1\n\n")
+            response = sock.recv(4096).decode("utf-8")
+            verify_response_status_line(response, "400")
+        finally:
+            sock.close()
+
+    def test_oversized_headers(self, http_client):
+        """Test oversized headers get an error response, not a reset"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(5.0)
+        try:
+            sock.connect((http_client.host, http_client.port))
+            request = "GET / HTTP/1.1\r\n" + "X-Filler: " + "x" * 70000 + "\r\n\r\n"
+            sock.sendall(request.encode("utf-8"))
+            response = sock.recv(4096).decode("utf-8")
+            verify_response_status_line(response, "431")
+            assert "Connection: close" in response
+        finally:
+            sock.close()
+
+    def test_chunked_request(self, http_client):
+        """Test a chunked request body is refused and the connection closed"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(5.0)
+        try:
+            sock.connect((http_client.host, http_client.port))
+            request = (
+                "POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n"
+                "4\r\ntest\r\n0\r\n\r\n"
+            )
+            sock.sendall(request.encode("utf-8"))
+            response = b""
+            while chunk := sock.recv(4096):
+                response += chunk
+            response = response.decode("utf-8")
+            verify_response_status_line(response, "501")
+            assert "Connection: close" in response
+        finally:
+            sock.close()
+
+    def test_empty_connection(self, http_client):
+        """Test server keeps serving after a client closes without sending"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(5.0)
+        try:
+            sock.connect((http_client.host, http_client.port))
+        finally:
+            sock.close()
+
+        response = http_client.send_request("GET", "/")
+        verify_response_status_line(response)
+
 
 class TestConnectionHandling:
     """Test connection handling"""
@@ -325,9 +526,6 @@ class TestConnectionHandling:
         assert response1.startswith("HTTP/1.1")
         assert response2.startswith("HTTP/1.1")
 
-    @pytest.mark.xfail(
-        reason="Server does not currently support keep-alive connections"
-    )
     def test_multiple_requests_same_connection(self, http_client):
         """Test multiple requests on same connection"""
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -356,17 +554,127 @@ class TestConnectionHandling:
         finally:
             sock.close()
 
+    def test_pipelined_requests(self, http_client):
+        """Test requests sent back to back before reading any response"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(5.0)
+        try:
+            sock.connect((http_client.host, http_client.port))
+            host = f"{http_client.host}:{http_client.port}"
+            requests = (
+                f"GET / HTTP/1.1\r\nHost: {host}\r\n\r\n"
+                f"POST / HTTP/1.1\r\nHost: {host}\r\nContent-Length: 4\r\n\r\ntest"
+                f"PUT /test HTTP/1.1\r\nHost: {host}\r\nConnection: close\r\n\r\n"
+            )
+            sock.sendall(requests.encode("utf-8"))
+
+            # The server closes after the last request, so read to EOF
+            response = b""
+            while chunk := sock.recv(4096):
+                response += chunk
+            statuses = re.findall(rb"HTTP/1\.1 (\d{3}) ", response)
+            assert statuses == [b"200", b"200", b"201"]
+        finally:
+            sock.close()
+
+    @pytest.mark.parametrize(
+        "framing",
+        [
+            "Content-Length: 4\r\nContent-Length: 0\r\n",
+            "Content-Length: 4\r\nTransfer-Encoding: chunked\r\n",
+        ],
+    )
+    def test_pipelined_ambiguous_length(self, http_client, framing):
+        """Test a request with conflicting lengths can't smuggle in another"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(5.0)
+        try:
+            sock.connect((http_client.host, http_client.port))
+            host = f"{http_client.host}:{http_client.port}"
+            requests = (
+                f"POST / HTTP/1.1\r\nHost: {host}\r\n{framing}\r\nabcd"
+                f"GET / HTTP/1.1\r\nHost: {host}\r\nConnection: close\r\n\r\n"
+            )
+            sock.sendall(requests.encode("utf-8"))
+
+            response = b""
+            while chunk := sock.recv(4096):
+                response += chunk
+            statuses = re.findall(rb"HTTP/1\.1 (\d{3}) ", response)
+            assert statuses == [b"400"]
+            assert b"Connection: close" in response
+        finally:
+            sock.close()
+
+    def test_pipelined_delete_then_get(self, http_client):
+        """Test a 204 response ends at its headers on a kept-alive connection"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(5.0)
+        try:
+            sock.connect((http_client.host, http_client.port))
+            host = f"{http_client.host}:{http_client.port}"
+            requests = (
+                f"DELETE /test HTTP/1.1\r\nHost: {host}\r\n\r\n"
+                f"GET / HTTP/1.1\r\nHost: {host}\r\nConnection: close\r\n\r\n"
+            )
+            sock.sendall(requests.encode("utf-8"))
+
+            response = b""
+            while chunk := sock.recv(4096):
+                response += chunk
+            delete_end = response.find(b"\r\n\r\n") + 4
+            delete_response = response[:delete_end].decode("utf-8")
+            verify_response_status_line(delete_response, "204")
+            assert "Content-Length:" not in delete_response
+            # The next response must start right where the 204 ends
+            verify_response_status_line(response[delete_end:].decode("utf-8"))
+        finally:
+            sock.close()
+
+
+class TestTimeouts:
+    """Test idle and slow connections are closed"""
+
+    def test_idle_connection_closed(self, short_timeout_server):
+        """Test a connection that sends nothing is closed without a reply"""
+        sock = socket.create_connection(short_timeout_server, timeout=5.0)
+        try:
+            assert sock.recv(4096) == b""
+        finally:
+            sock.close()
+
+    def test_slow_request_times_out(self, short_timeout_server):
+        """Test a request trickled in byte by byte gets a 408"""
+        sock = socket.create_connection(short_timeout_server, timeout=5.0)
+        try:
+            response = b""
+            # Each byte arrives well within the timeout, the request never does
+            for byte in b"GET / HTTP/1.1\r\nX-Slow: yes":
+                sock.send(bytes([byte]))
+                readable, _, _ = select.select([sock], [], [], 0.1)
+                if readable:
+                    break
+            while chunk := sock.recv(4096):
+                response += chunk
+            response = response.decode("utf-8")
+            verify_response_status_line(response, "408")
+            assert "Connection: close" in response
+        finally:
+            sock.close()
+
 
 class TestConcurrency:
     """Test concurrent request handling"""
 
-    @pytest.mark.skip("Server does not currently support concurrent connections")
     def test_concurrent_requests(self, http_client):
         """Test server handles concurrent requests"""
 
         def make_request():
             client = HTTPClient(http_client.host, http_client.port)
-            return client.send_request("GET", "/")
+            try:
+                return client.send_request("GET", "/")
+            finally:
+                client.close()
 
         # Start multiple threads
         threads = []
@@ -392,6 +700,26 @@ class TestConcurrency:
             verify_response_status_line(result)
 
 
+class TestWorkers:
+    """Test the multi-process supervisor"""
+
+    @pytest.mark.skipif(
+        not hasattr(socket, "SO_REUSEPORT"), reason="needs SO_REUSEPORT"
+    )
+    def test_worker_failure_is_reported(self):
+        """Test a worker that cannot start makes serve_forever_multi fail"""
+
+        class FailingWorkerServer(SimpleHTTPServer):
+            @staticmethod
+            def _bind(hostname, port, reuse_port=False):
+                if reuse_port:
+                    raise OSError("worker bind failed")
+                return SimpleHTTPServer._bind(hostname, port)
+
+        server = FailingWorkerServer("127.0.0.1", 0)
+        assert server.serve_forever_multi(workers=2) == -1
+
+
 # Configuration for pytest
 def pytest_configure(config):
     """Configure pytest markers"""
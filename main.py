@@ -1,104 +1,424 @@
+import asyncio
+import logging
+import os
+import re
 import socket
 
+log = logging.getLogger(__name__)
+
+_STATUS_LINES = {
+    200: b"HTTP/1.1 200 OK\r\n",
+    201: b"HTTP/1.1 201 Created\r\n",
+    204: b"HTTP/1.1 204 No Content\r\n",
+    400: b"HTTP/1.1 400 Bad Request\r\n",
+    405: b"HTTP/1.1 405 Method Not Allowed\r\n",
+    408: b"HTTP/1.1 408 Request Timeout\r\n",
+    413: b"HTTP/1.1 413 Content Too Large\r\n",
+    431: b"HTTP/1.1 431 Request Header Fields Too Large\r\n",
+    500: b"HTTP/1.1 500 Internal Server Error\r\n",
+    501: b"HTTP/1.1 501 Not Implemented\r\n",
+}
+
+
+def _make_resp(code, msg=b"", close=False):
+    connection = b"Connection: close\r\n" if close else b""
+    if code == 204:
+        # A 204 ends at its headers; a Content-Length or body would be read
+        # as the start of the next response on a kept-alive connection.
+        return _STATUS_LINES[code] + connection + b"\r\n"
+    return b"".join(
+        (
+            _STATUS_LINES[code],
+            connection,
+            b"Content-Length: ",
+            str(len(msg)).encode("ascii"),
+            b"\r\nContent-Type: text/html\r\n\r\n",
+            msg,
+        )
+    )
+
+
+def _parse_request_line(data, limit):
+    """Split the request line at the start of data into (method, path, version).
+
+    data may be a memoryview over a receive buffer; only the first limit bytes
+    are copied out. Returns None if no CRLF ends the line within them.
+    """
+    line = bytes(data[:limit])
+    line_end = line.find(b"\r\n")
+    if line_end < 0:
+        return None
+    method_end = line.find(b" ", 0, line_end)
+    if method_end < 0:
+        return line[:line_end], b"", b""
+    path_end = line.find(b" ", method_end + 1, line_end)
+    if path_end < 0:
+        return line[:method_end], line[method_end + 1 : line_end], b""
+    return (
+        line[:method_end],
+        line[method_end + 1 : path_end],
+        line[path_end + 1 : line_end],
+    )
+
+
+_FRAMING_HEADERS_RE = re.compile(
+    rb"\r\n(content-length|transfer-encoding|connection)[ \t]*:[ \t]*([^\r\n]*)",
+    re.IGNORECASE,
+)
+
+
+def _framing_headers(head):
+    """Map lower-cased names to values for the headers that frame a request.
+
+    Only Content-Length, Transfer-Encoding and Connection are picked out of
+    head; the other header lines are left alone. Repeated headers are joined
+    with commas. Returns None if the body length is ambiguous: Content-Length
+    given twice with different values, or alongside Transfer-Encoding.
+    """
+    headers = {}
+    for name, value in _FRAMING_HEADERS_RE.findall(head):
+        name, value = name.lower(), value.strip()
+        if name in headers and headers[name] != value:
+            if name == b"content-length":
+                return None
+            value = headers[name] + b", " + value
+        headers[name] = value
+    if b"transfer-encoding" in headers and b"content-length" in headers:
+        return None
+    return headers
+
+
+def _bare_lf_request_line(buf, start, end):
+    """Whether the request line in buf[start:end] ends in LF without a CR."""
+    line_end = buf.find(b"\n", start, end)
+    return line_end >= 0 and (line_end == start or buf[line_end - 1] != ord("\r"))
+
+
+def _keep_alive(version, headers):
+    """Whether the connection stays open after answering this request.
+
+    HTTP/1.1 is persistent unless the client sends Connection: close; older
+    versions only persist when the client asks for keep-alive.
+    """
+    tokens = {
+        token.strip().lower() for token in headers.get(b"connection", b"").split(b",")
+    }
+    if version == b"HTTP/1.1":
+        return b"close" not in tokens
+    return b"keep-alive" in tokens
+
 
 class SimpleHTTPServer:
     _socket = None
     METHODS_MAP = {}
-    SUPPORTED_PROTOCOL = "HTTP/1.1"
+    RECV_BUFFER_SIZE = 65536
+    MAX_POOLED_BUFFERS = 16
+    MAX_REQUEST_LINE = 8192
+    MAX_REQUEST_SIZE = 1048576
+    KEEPALIVE_TIMEOUT = 5
+    REQUEST_TIMEOUT = 10
+    LINGER_TIMEOUT = 1
 
     def __init__(self, hostname="", port=8080) -> None:
-        print("Initializing SimpleHTTPServer")
-        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._socket.bind((hostname, port))
+        log.info("Initializing SimpleHTTPServer")
+        self._socket = self._bind(hostname, port)
+        # Receive buffers are reused across connections instead of
+        # allocating a new bytes object for every recv.
+        self._buffers = []
         self.METHODS_MAP = {
-            "GET": self.get_handler,
-            "POST": self.post_handler,
-            "PUT": self.put_handler,
-            "DELETE": self.delete_handler,
-            "HEAD": self.head_handler,
+            b"GET": self.get_handler,
+            b"POST": self.post_handler,
+            b"PUT": self.put_handler,
+            b"DELETE": self.delete_handler,
+            b"HEAD": self.head_handler,
         }
 
+    @staticmethod
+    def _bind(hostname, port, reuse_port=False):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if reuse_port:
+            # Lets each worker in serve_forever_multi bind its own socket to
+            # the same address and have the kernel balance connections.
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((hostname, port))
+        return sock
+
     def get_handler(self, *args, **kwargs):
-        return self._basic_ok("You called GET, Not Sure what to do next")
+        return _make_resp(200, b"You called GET, Not Sure what to do next")
 
     def post_handler(self, *args, **kwargs):
-        return self._basic_ok("You called POST, Not Sure what to do next")
+        return _make_resp(200, b"You called POST, Not Sure what to do next")
 
     def put_handler(self, *args, **kwargs):
-        return self._basic_ok("You called PUT, Not Sure what to do next", "201 Created")
+        return _make_resp(201, b"You called PUT, Not Sure what to do next")
 
     def delete_handler(self, *args, **kwargs):
-        return self._basic_ok(
-            "You called DELETE, Not Sure what to do next", "204 No Content"
-        )
+        return _make_resp(204)
 
     def head_handler(self, *args, **kwargs):
-        return self._basic_ok("")
+        return _make_resp(200)
 
     def serve(self):
         if self._socket is None:
-            print("must initialize class first!")
+            log.error("must initialize class first!")
             return -1
-        self._socket.listen(1)
+        self._socket.listen(socket.SOMAXCONN)
+        self._socket.setblocking(False)
+        try:
+            asyncio.run(self._accept_loop())
+        except KeyboardInterrupt:
+            pass
+        log.info("Server stopping")
+
+    def serve_forever_multi(self, workers=None):
+        if self._socket is None:
+            log.error("must initialize class first!")
+            return -1
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if workers < 2 or not hasattr(socket, "SO_REUSEPORT"):
+            return self.serve()
+        # The parent only supervises. Its socket was bound without
+        # SO_REUSEPORT and would block the workers from binding, so release
+        # the address and let each worker take it with SO_REUSEPORT set.
+        address = self._socket.getsockname()
+        self._socket.close()
+        self._socket = None
+        children = set()
+        for _ in range(workers):
+            pid = os.fork()
+            if pid == 0:
+                # os._exit skips the usual traceback, so report failures here.
+                exit_code = 0
+                try:
+                    self._socket = self._bind(*address, reuse_port=True)
+                    self.serve()
+                except Exception:
+                    log.exception("Worker %d failed", os.getpid())
+                    exit_code = 1
+                finally:
+                    os._exit(exit_code)
+            children.add(pid)
+        failed = 0
+        while children:
+            try:
+                pid, status = os.wait()
+            except KeyboardInterrupt:
+                # Workers get the same SIGINT and shut down on their own.
+                continue
+            children.discard(pid)
+            exit_code = os.waitstatus_to_exitcode(status)
+            if exit_code != 0:
+                log.error("Worker %d exited with status %d", pid, exit_code)
+                failed += 1
+        if failed:
+            log.error("%d of %d workers failed", failed, workers)
+            return -1
+        log.info("All workers stopped")
+
+    async def _accept_loop(self):
+        loop = asyncio.get_running_loop()
+        # Keep a reference to each connection task so it isn't garbage
+        # collected mid-request.
+        tasks = set()
         while True:
-            conn, addr = self._socket.accept()
-            with conn:
-                print("Ready for connection")
-                data = conn.recv(1024)
-                if not data:
-                    break
-                response_data = self.read_handler(data)
-                self.write_handler(conn, response_data)
-            print("Ending connection")
-        print("Server stopping")
-
-    def read_handler(self, data):
-        s_data = data.decode("utf8")
-        print(f"RX: {data}")
-        lines = s_data.split("\n")
+            conn, addr = await loop.sock_accept(self._socket)
+            # Requests and responses are small; don't let Nagle or delayed
+            # ACKs hold them back.
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if hasattr(socket, "TCP_QUICKACK"):
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+            task = loop.create_task(self._handle(conn))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+    async def _handle(self, conn):
+        with conn:
+            log.debug("Ready for connection")
+            buf = self._acquire_buffer()
+            try:
+                await self._serve_requests(conn, buf)
+            except ConnectionError as e:
+                # The client went away; that only ends this connection.
+                log.debug("Connection error: %s", e)
+                return
+            finally:
+                self._release_buffer(buf)
+        log.debug("Ending connection")
+
+    async def _serve_requests(self, conn, buf):
+        """Answer requests on conn, in order, until the connection should close.
+
+        Unconsumed bytes live in buf[start:end], so pipelined requests are
+        served straight from the buffer without another recv. A request too
+        big for buf moves to a larger buffer of its own, grown as its body
+        arrives. A connection that sends nothing for KEEPALIVE_TIMEOUT
+        seconds is closed, and a request that hasn't fully arrived within
+        REQUEST_TIMEOUT seconds of its first byte gets a 408.
+        """
+        loop = asyncio.get_running_loop()
+        view = memoryview(buf)
+        start = end = 0
+        deadline = None
+        while True:
+            request_size = None
+            header_end = buf.find(b"\r\n\r\n", start, end)
+            if header_end >= 0:
+                # Keep the CRLF ending the last line so a request with no
+                # headers still has a terminated request line.
+                head = bytes(view[start : header_end + 2])
+                start_line = _parse_request_line(head, self.MAX_REQUEST_LINE)
+                if start_line is None:
+                    await self._reject(conn, view, 400, b"Get out of here with that")
+                    return
+                headers = _framing_headers(head)
+                if headers is None:
+                    # Honouring either length would let a body smuggle in a
+                    # request the client never meant to send.
+                    await self._reject(conn, view, 400, b"Ambiguous message length")
+                    return
+                if b"transfer-encoding" in headers:
+                    # Chunked bodies aren't supported, and without a length
+                    # the end of the request can't be found.
+                    await self._reject(
+                        conn, view, 501, b"Transfer-Encoding not supported"
+                    )
+                    return
+                keep_alive = _keep_alive(start_line[2], headers)
+                content_length = headers.get(b"content-length", b"0")
+                if not content_length.isdigit():
+                    await self._reject(conn, view, 400, b"Bad Content-Length")
+                    return
+                request_end = header_end + 4 + int(content_length)
+                if request_end - start > self.MAX_REQUEST_SIZE:
+                    await self._reject(conn, view, 413, b"Request too large")
+                    return
+                if request_end <= end:
+                    response_data = self.read_handler(
+                        view[start:request_end], start_line
+                    )
+                    if keep_alive and start_line[2] != b"HTTP/1.1":
+                        # Older clients only reuse the connection if the
+                        # response confirms it.
+                        line_end = response_data.index(b"\r\n") + 2
+                        response_data = b"".join(
+                            (
+                                response_data[:line_end],
+                                b"Connection: keep-alive\r\n",
+                                response_data[line_end:],
+                            )
+                        )
+                    await self.write_handler(conn, response_data)
+                    if not keep_alive:
+                        return
+                    start = request_end
+                    deadline = None
+                    continue
+                request_size = request_end - start
+            elif end - start >= self.RECV_BUFFER_SIZE:
+                await self._reject(conn, view, 431, b"Request headers too large")
+                return
+            elif _bare_lf_request_line(buf, start, end):
+                await self._reject(conn, view, 400, b"Request line must end in CRLF")
+                return
+
+            # Make room for more data
+            if start == end:
+                start = end = 0
+            elif end == len(buf):
+                if start > 0:
+                    buf[: end - start] = buf[start:end]
+                    start, end = 0, end - start
+                else:
+                    # Oversized headers were turned away above, so a full
+                    # buffer holds one request whose body is still arriving.
+                    bigger = bytearray(min(2 * len(buf), request_size))
+                    bigger[:end] = view[:end]
+                    buf, view = bigger, memoryview(bigger)
+            if start == end:
+                timeout = self.KEEPALIVE_TIMEOUT
+            else:
+                # Time the whole request, not each recv, so a client can't
+                # hold the connection by trickling in a byte at a time.
+                if deadline is None:
+                    deadline = loop.time() + self.REQUEST_TIMEOUT
+                timeout = max(deadline - loop.time(), 0)
+            try:
+                nbytes = await asyncio.wait_for(
+                    loop.sock_recv_into(conn, view[end:]), timeout
+                )
+            except asyncio.TimeoutError:
+                if start == end:
+                    log.debug("Connection idle, closing")
+                    return
+                await self._reject(conn, view, 408, b"Request timed out")
+                return
+            if not nbytes:
+                return
+            end += nbytes
+
+    async def _reject(self, conn, view, code, msg):
+        """Send an error reply and wind down a connection that can't continue.
+
+        The rest of the request is usually still unread, and closing a socket
+        with unread data makes the kernel send a RST that can discard the
+        reply before the client reads it. So half-close, then drain whatever
+        the client is still sending for up to LINGER_TIMEOUT seconds.
+        """
+        loop = asyncio.get_running_loop()
+        await self.write_handler(conn, _make_resp(code, msg, close=True))
+        conn.shutdown(socket.SHUT_WR)
+        deadline = loop.time() + self.LINGER_TIMEOUT
         try:
-            start_line = lines[0].split(" ")
-        except TypeError:
-            print(f"Error trying to read: {lines[0]}")
-            return "HTTP/1.1 400 Bad Request\nGet out of here with that\n\n"
-        if start_line[0] not in self.METHODS_MAP:
-            if len(start_line) < 3 or start_line[2] != "HTTP/1.1":
-                return "HTTP/1.1 400 Bad request"
-            return f"HTTP/1.1 405 Method not allowed\nI only support {self.METHODS_MAP}\n\n"
-
-        response_data = self.METHODS_MAP[start_line[0]](start_line, lines)
+            while (remaining := deadline - loop.time()) > 0:
+                recv = loop.sock_recv_into(conn, view)
+                if not await asyncio.wait_for(recv, remaining):
+                    break
+        except asyncio.TimeoutError:
+            pass
+
+    def _acquire_buffer(self):
+        if self._buffers:
+            return self._buffers.pop()
+        return bytearray(self.RECV_BUFFER_SIZE)
+
+    def _release_buffer(self, buf):
+        # Keep only enough buffers for a typical load; any beyond the cap
+        # left over from a burst of connections are dropped.
+        if len(self._buffers) < self.MAX_POOLED_BUFFERS:
+            self._buffers.append(buf)
+
+    def read_handler(self, data, start_line=None):
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("RX: %r", bytes(data))
+        # _serve_requests has usually parsed the request line already
+        if start_line is None:
+            start_line = _parse_request_line(data, self.MAX_REQUEST_LINE)
+        if start_line is None:
+            log.debug("Error trying to read: %r", bytes(data[:80]))
+            return _make_resp(400, b"Get out of here with that")
+        method, path, version = start_line
+        handler = self.METHODS_MAP.get(method)
+        if handler is None:
+            if version != b"HTTP/1.1":
+                return _make_resp(400, b"Bad request")
+            allowed = b", ".join(self.METHODS_MAP)
+            return _make_resp(405, b"I only support " + allowed)
+
+        response_data = handler(start_line, data)
         if not response_data:
-            print("No response data, returning basic OK")
-            response_data = self._basic_error(
-                "Uhhh, something didn't work", "500 Internal Server Error"
-            )
+            log.warning("No response data, returning basic OK")
+            response_data = _make_resp(500, b"Uhhh, something didn't work")
         return response_data
 
-    def _basic_ok(self, msg=None, response_code="200 Ok"):
-        msg_len = len(msg) if msg else 0
-        return f"""{self.SUPPORTED_PROTOCOL} {response_code}\r
-Content-Length: {msg_len}\r
-Content-Type: text/html\r
-\r
-{msg}
-"""
-
-    def _basic_error(self, msg=None, error_code="400 Whoops"):
-        msg_len = len(msg) if msg else 0
-        return f"""{self.SUPPORTED_PROTOCOL} {error_code}\r
-Content-Length: {msg_len}\r
-Content-Type: text/html\r
-\r
-{msg}
-"""
-
-    def write_handler(self, conn, data):
-        conn.sendall(bytes(f"{data} \n".encode("utf8")))
-        conn.close()
+    async def write_handler(self, conn, data):
+        loop = asyncio.get_running_loop()
+        await loop.sock_sendall(conn, data)
         return
 
 
 def main():
+    logging.basicConfig(level=logging.INFO)
     print("Hello from httpserver-simple!")
     server = SimpleHTTPServer()
     server.serve()